@@ -4,6 +4,10 @@ Fixes:
 - Provided a safe llm fallback (None) and attempt to initialize an OpenAI-like LLM when OPENAI_API_KEY is present.
 - Cleaned and corrected agent prompts to avoid hallucination and unsafe instructions.
 - Used consistent 'tools' parameter name and pass callable references.
+- Enabled provider prompt caching for the static agent prompts (Anthropic via cache_control, OpenAI via stable prefixes).
+- Replaced per-agent max_rpm with one shared per-provider rate limiter.
+- Split into LLM_FAST (verifier, advisor, risk) and LLM_DEEP (analyst) to route by task complexity.
+- Built agents through per-request factory functions so concurrent crews don't share mutable state.
 """
 import os
 from dotenv import load_dotenv
@@ -11,79 +15,126 @@ load_dotenv()
 
 from crewai.agents import Agent
 
-llm = None
-try:
-    # Attempting to import an LLM from crewai (if available). If not present, llm stays None.
-    from crewai.llms import OpenAI
-    api_key = os.getenv("OPENAI_API_KEY")
-    if api_key:
-        llm = OpenAI(api_key=api_key)
-except Exception:
-    llm = None
+from ratelimit import make_limiter, rate_limited
+
+# Inject an ephemeral cache breakpoint after the system message (role/goal/backstory),
+# so the static agent prompt prefix is billed at the cached-input rate on every call.
+PROMPT_CACHE_POINTS = [{"location": "message", "role": "system"}]
+
+# Route by task complexity: the deep model does the full analysis, while
+# verification and the educational/risk commentary run on a cheaper fast model.
+# Point FAST_LLM_BASE_URL at an OpenAI-compatible server (e.g. vLLM with a quantized
+# small model) to self-host the fast tier.
+LLM_FAST = None
+LLM_DEEP = None
+# Each provider is set up in its own try, so a missing or broken OpenAI client
+# doesn't also disable the Anthropic path (and vice versa).
+api_key = os.getenv("OPENAI_API_KEY")
+if api_key:
+    try:
+        from crewai.llms import OpenAI
+        # OpenAI caches identical prompt prefixes automatically; keeping the static
+        # agent/task text ahead of the per-request inputs is what makes it hit.
+        limiter = make_limiter("openai")
+        fast_kwargs = {"base_url": os.getenv("FAST_LLM_BASE_URL")} if os.getenv("FAST_LLM_BASE_URL") else {}
+        LLM_FAST = rate_limited(OpenAI(
+            api_key=api_key,
+            model=os.getenv("FAST_MODEL", "gpt-4o-mini"),
+            **fast_kwargs,
+        ), limiter)
+        LLM_DEEP = rate_limited(OpenAI(
+            api_key=api_key,
+            model=os.getenv("DEEP_MODEL", "gpt-4o"),
+        ), limiter)
+    except Exception:
+        LLM_FAST = None
+        LLM_DEEP = None
+
+if LLM_DEEP is None and os.getenv("ANTHROPIC_API_KEY"):
+    try:
+        from crewai import LLM
+        limiter = make_limiter("anthropic")
+        LLM_FAST = rate_limited(LLM(
+            model=os.getenv("ANTHROPIC_FAST_MODEL", "anthropic/claude-3-5-haiku-latest"),
+            api_key=os.getenv("ANTHROPIC_API_KEY"),
+            cache_control_injection_points=PROMPT_CACHE_POINTS,
+        ), limiter)
+        LLM_DEEP = rate_limited(LLM(
+            model=os.getenv("ANTHROPIC_MODEL", "anthropic/claude-3-5-sonnet-latest"),
+            api_key=os.getenv("ANTHROPIC_API_KEY"),
+            cache_control_injection_points=PROMPT_CACHE_POINTS,
+        ), limiter)
+    except Exception:
+        LLM_FAST = None
+        LLM_DEEP = None
 
 from tools import search_tool, FinancialDocumentTool
 
+# Agents are built per request: CrewAI mutates agents during a run (agent.crew,
+# the agent executor, step_callback), so sharing module-level instances between
+# concurrent kickoffs would mix up requests.
+
 # Creating an Experienced Financial Analyst agent
-financial_analyst = Agent(
-    role="Senior Financial Analyst",
-    goal="Analyze the provided financial document, extract key financial statements and metrics, compute commonly used ratios, and provide a clear, well-explained summary. If calculations are uncertain, state assumptions explicitly.",
-    verbose=True,
-    memory=True,
-    backstory=(
-        "You are an experienced financial analyst. You read documents carefully, extract numbers precisely, and avoid making up facts."
-        "Always include a short disclaimer that this is not personalized financial advice."
-    ),
-    tools=[FinancialDocumentTool.read_data_tool, search_tool] if hasattr(FinancialDocumentTool, "read_data_tool") else [search_tool],
-    llm=llm,
-    max_iter=3,
-    max_rpm=10,
-    allow_delegation=True
-)
+def make_financial_analyst():
+    return Agent(
+        role="Senior Financial Analyst",
+        goal="Analyze the provided financial document, extract key financial statements and metrics, compute commonly used ratios, and provide a clear, well-explained summary. If calculations are uncertain, state assumptions explicitly.",
+        verbose=True,
+        memory=True,
+        backstory=(
+            "You are an experienced financial analyst. You read documents carefully, extract numbers precisely, and avoid making up facts."
+            "Always include a short disclaimer that this is not personalized financial advice."
+        ),
+        tools=[FinancialDocumentTool.read_data_tool, search_tool] if hasattr(FinancialDocumentTool, "read_data_tool") else [search_tool],
+        llm=LLM_DEEP,
+        max_iter=3,
+        allow_delegation=True
+    )
 
 # Creating a document verifier agent 
-verifier = Agent(
-    role="Financial Document Verifier",
-    goal="Verify whether the uploaded file looks like a financial document. Return a JSON-like summary with keys: is_financial_document (bool), doc_type (e.g., 'financial_statement', 'invoice', 'unknown'), and short_explanation.",
-    verbose=True,
-    memory=False,
-    backstory=(
-        "You were trained to identify common financial documents (balance sheet, income statement, cash flow)."
-        "If uncertain, return is_financial_document: False and explain why."
-    ),
-    tools=[FinancialDocumentTool.read_data_tool] if hasattr(FinancialDocumentTool, "read_data_tool") else [],
-    llm=llm,
-    max_iter=2,
-    max_rpm=10,
-    allow_delegation=False
-)
+def make_verifier():
+    return Agent(
+        role="Financial Document Verifier",
+        goal="Verify whether the uploaded file looks like a financial document. Return a JSON-like summary with keys: is_financial_document (bool), doc_type (e.g., 'financial_statement', 'invoice', 'unknown'), and short_explanation.",
+        verbose=True,
+        memory=False,
+        backstory=(
+            "You were trained to identify common financial documents (balance sheet, income statement, cash flow)."
+            "If uncertain, return is_financial_document: False and explain why."
+        ),
+        tools=[FinancialDocumentTool.read_data_tool] if hasattr(FinancialDocumentTool, "read_data_tool") else [],
+        llm=LLM_FAST,
+        max_iter=2,
+        allow_delegation=False
+    )
 
-investment_advisor = Agent(
-    role="Investment Advisor (Educational Only)",
-    goal="Based on extracted financial metrics, provide educational insights: possible strengths, weaknesses, and what an investor might want to investigate further. Do NOT sell products or provide personalized financial advice.",
-    verbose=True,
-    memory=False,
-    backstory=(
-        "You provide general educational commentary about investments and risks."
-    ),
-    llm=llm,
-    tools=[FinancialDocumentTool.read_data_tool] if hasattr(FinancialDocumentTool, "read_data_tool") else [],
-    max_iter=2,
-    max_rpm=10,
-    allow_delegation=False
-)
+def make_investment_advisor():
+    return Agent(
+        role="Investment Advisor (Educational Only)",
+        goal="Based on extracted financial metrics, provide educational insights: possible strengths, weaknesses, and what an investor might want to investigate further. Do NOT sell products or provide personalized financial advice.",
+        verbose=True,
+        memory=False,
+        backstory=(
+            "You provide general educational commentary about investments and risks."
+        ),
+        llm=LLM_FAST,
+        tools=[FinancialDocumentTool.read_data_tool] if hasattr(FinancialDocumentTool, "read_data_tool") else [],
+        max_iter=2,
+        allow_delegation=False
+    )
 
 
-risk_assessor = Agent(
-    role="Risk Assessment Specialist",
-    goal="Using computed ratios and available data, produce a concise risk assessment with clear reasoning, assumptions, and recommended next steps for due diligence.",
-    verbose=True,
-    memory=False,
-    backstory=(
-        "You are focused on coherent, well-explained risk assessments based on available data."
-    ),
-    llm=llm,
-    tools=[FinancialDocumentTool.read_data_tool] if hasattr(FinancialDocumentTool, "read_data_tool") else [],
-    max_iter=2,
-    max_rpm=10,
-    allow_delegation=False
-)
+def make_risk_assessor():
+    return Agent(
+        role="Risk Assessment Specialist",
+        goal="Using computed ratios and available data, produce a concise risk assessment with clear reasoning, assumptions, and recommended next steps for due diligence.",
+        verbose=True,
+        memory=False,
+        backstory=(
+            "You are focused on coherent, well-explained risk assessments based on available data."
+        ),
+        llm=LLM_FAST,
+        tools=[FinancialDocumentTool.read_data_tool] if hasattr(FinancialDocumentTool, "read_data_tool") else [],
+        max_iter=2,
+        allow_delegation=False
+    )
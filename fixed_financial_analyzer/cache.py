@@ -0,0 +1,287 @@
+"""
+Two-tier response cache for /analyze:
+- Exact tier: Redis key fa:{doc_hash}:{query_hash} (in-process dict when Redis is unavailable).
+- Semantic tier: per-document FAISS index of query embeddings; a prior query with
+  cosine similarity >= SEMANTIC_THRESHOLD against the same document is treated as a hit.
+  Embeddings are stored with each response and the index is rebuilt from Redis, so the
+  semantic tier is shared across workers and survives restarts.
+In-process stores are bounded and expire with CACHE_TTL_SECONDS.
+Concurrent identical requests are coalesced onto one in-flight run.
+Both tiers are optional and degrade to a cache miss if their dependencies are missing.
+"""
+import os
+import json
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+
+try:
+    import redis.asyncio as aioredis
+except Exception:
+    aioredis = None
+
+try:
+    import numpy as np
+    import faiss
+    from sentence_transformers import SentenceTransformer
+except Exception:
+    SentenceTransformer = None
+
+CACHE_TTL_SECONDS = int(os.getenv("CACHE_TTL_SECONDS", "86400"))
+SEMANTIC_THRESHOLD = 0.9
+# Look past the nearest neighbour so one expired entry can't mask a live match
+SEMANTIC_TOP_K = 8
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+# Bounds for the in-process stores (LRU-evicted beyond these)
+MAX_LOCAL_ENTRIES = 1024
+MAX_INDEXED_DOCS = 256
+
+
+def _query_hash(query: str) -> str:
+    return hashlib.sha256(query.strip().lower().encode("utf-8")).hexdigest()
+
+
+def _key(doc_hash: str, query_hash: str) -> str:
+    return f"fa:{doc_hash}:{query_hash}"
+
+
+def _members_key(doc_hash: str) -> str:
+    # Redis set of query hashes cached for a document, used to rebuild its semantic index
+    return f"fa:{doc_hash}:queries"
+
+
+def _decode(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+class _QueryIndex:
+    """Query embeddings for one document; the FAISS index is rebuilt lazily after changes."""
+
+    def __init__(self):
+        self.hashes = []
+        self._vectors = []
+        self._index = None
+
+    def add(self, query_hash, vector):
+        if query_hash in self.hashes:
+            return
+        self.hashes.append(query_hash)
+        self._vectors.append(np.asarray(vector, dtype="float32").reshape(-1))
+        self._index = None
+
+    def remove(self, query_hashes):
+        drop = set(query_hashes)
+        if not drop.intersection(self.hashes):
+            return
+        kept = [(h, v) for h, v in zip(self.hashes, self._vectors) if h not in drop]
+        self.hashes = [h for h, _ in kept]
+        self._vectors = [v for _, v in kept]
+        self._index = None
+
+    def search(self, embedding, k):
+        """Return [(query_hash, score), ...] best first."""
+        if not self.hashes:
+            return []
+        if self._index is None:
+            self._index = faiss.IndexFlatIP(self._vectors[0].shape[0])
+            self._index.add(np.stack(self._vectors))
+        scores, ids = self._index.search(embedding, min(k, len(self.hashes)))
+        return [(self.hashes[i], score) for score, i in zip(scores[0], ids[0]) if i >= 0]
+
+
+class AnalysisCache:
+    def __init__(self, redis_url=None):
+        self._redis = None
+        redis_url = redis_url or os.getenv("REDIS_URL")
+        if aioredis is not None and redis_url:
+            self._redis = aioredis.from_url(redis_url)
+        # key -> (expires_at, value), least recently used first
+        self._local = OrderedDict()
+        self._model = None
+        # doc_hash -> _QueryIndex, least recently used first
+        self._indexes = OrderedDict()
+        # key -> Future resolved by the request currently running that analysis
+        self._inflight = {}
+
+    async def _get_raw(self, key):
+        if self._redis is not None:
+            try:
+                return await self._redis.get(key)
+            except Exception:
+                pass
+        entry = self._local.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._local[key]
+            return None
+        self._local.move_to_end(key)
+        return value
+
+    async def _set_raw(self, key, value):
+        if self._redis is not None:
+            try:
+                await self._redis.set(key, value, ex=CACHE_TTL_SECONDS)
+                return
+            except Exception:
+                pass
+        self._local[key] = (time.monotonic() + CACHE_TTL_SECONDS, value)
+        self._local.move_to_end(key)
+        while len(self._local) > MAX_LOCAL_ENTRIES:
+            self._local.popitem(last=False)
+
+    def _index_for(self, doc_hash: str, create: bool = False):
+        index = self._indexes.get(doc_hash)
+        if index is None and create:
+            index = self._indexes[doc_hash] = _QueryIndex()
+            while len(self._indexes) > MAX_INDEXED_DOCS:
+                self._indexes.popitem(last=False)
+        if index is not None:
+            self._indexes.move_to_end(doc_hash)
+        return index
+
+    async def _sync_from_redis(self, doc_hash: str):
+        """
+        Bring the local index for doc_hash in line with the query set in Redis, so
+        the semantic tier survives restarts and is shared across workers.
+        """
+        try:
+            members = {_decode(m) for m in await self._redis.smembers(_members_key(doc_hash))}
+        except Exception:
+            return
+        index = self._index_for(doc_hash, create=bool(members))
+        if index is None:
+            return
+        index.remove([h for h in index.hashes if h not in members])
+        missing = [h for h in members if h not in index.hashes]
+        if not missing:
+            return
+        try:
+            raws = await self._redis.mget([_key(doc_hash, h) for h in missing])
+        except Exception:
+            return
+        dead = []
+        for query_hash, raw in zip(missing, raws):
+            embedding = json.loads(raw).get("embedding") if raw is not None else None
+            if embedding is None:
+                dead.append(query_hash)
+            else:
+                index.add(query_hash, embedding)
+        await self._forget(doc_hash, dead)
+
+    async def _forget(self, doc_hash: str, query_hashes):
+        """Drop query hashes whose cached response has expired or been evicted."""
+        if not query_hashes:
+            return
+        index = self._indexes.get(doc_hash)
+        if index is not None:
+            index.remove(query_hashes)
+        if self._redis is not None:
+            try:
+                await self._redis.srem(_members_key(doc_hash), *query_hashes)
+            except Exception:
+                pass
+
+    def _embed(self, query: str):
+        if self._model is None:
+            self._model = SentenceTransformer(EMBEDDING_MODEL)
+        vec = self._model.encode([query], normalize_embeddings=True)
+        return np.asarray(vec, dtype="float32")
+
+    async def _embedding(self, query: str):
+        if SentenceTransformer is None:
+            return None
+        try:
+            return await asyncio.to_thread(self._embed, query)
+        except Exception:
+            return None
+
+    async def get(self, doc_hash: str, query: str):
+        """
+        Return (cached analysis, query embedding). The embedding is returned so a
+        subsequent set() on a miss does not have to recompute it.
+        """
+        query_hash = _query_hash(query)
+        raw = await self._get_raw(_key(doc_hash, query_hash))
+        if raw is not None:
+            return json.loads(raw)["response"], None
+
+        embedding = await self._embedding(query)
+        if embedding is None:
+            return None, None
+        if self._redis is not None:
+            await self._sync_from_redis(doc_hash)
+        index = self._index_for(doc_hash)
+        if index is None:
+            return None, embedding
+
+        stale = []
+        try:
+            for candidate, score in index.search(embedding, SEMANTIC_TOP_K):
+                if score < SEMANTIC_THRESHOLD:
+                    break
+                raw = await self._get_raw(_key(doc_hash, candidate))
+                if raw is None:
+                    stale.append(candidate)
+                    continue
+                return json.loads(raw)["response"], embedding
+        finally:
+            await self._forget(doc_hash, stale)
+        return None, embedding
+
+    async def set(self, doc_hash: str, query: str, response: str, embedding=None):
+        query_hash = _query_hash(query)
+        if embedding is None:
+            embedding = await self._embedding(query)
+        value = {"response": response}
+        if embedding is not None:
+            value["embedding"] = embedding[0].tolist()
+        await self._set_raw(_key(doc_hash, query_hash), json.dumps(value))
+        if embedding is None:
+            return
+        self._index_for(doc_hash, create=True).add(query_hash, embedding[0])
+        if self._redis is not None:
+            try:
+                await self._redis.sadd(_members_key(doc_hash), query_hash)
+                await self._redis.expire(_members_key(doc_hash), CACHE_TTL_SECONDS)
+            except Exception:
+                pass
+
+    def join_inflight(self, doc_hash: str, query: str):
+        """
+        Return (is_leader, future). The first caller for a key becomes the leader
+        and starts the run, which must end in finish_inflight(); later callers
+        await the future instead of starting their own crew run.
+        """
+        key = _key(doc_hash, _query_hash(query))
+        future = self._inflight.get(key)
+        if future is not None:
+            return False, future
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        return True, future
+
+    def finish_inflight(self, doc_hash: str, query: str, result=None, error=None, release: bool = True):
+        """
+        Resolve the in-flight future. With release=False the resolved entry stays
+        registered, so callers arriving before the result is stored join it instead
+        of starting a duplicate run; release_inflight() drops it afterwards.
+        """
+        key = _key(doc_hash, _query_hash(query))
+        future = self._inflight.pop(key, None) if release else self._inflight.get(key)
+        if future is None or future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+            # Mark retrieved so a leader with no followers doesn't log an unhandled exception
+            future.exception()
+        else:
+            future.set_result(result)
+
+    def release_inflight(self, doc_hash: str, query: str):
+        self._inflight.pop(_key(doc_hash, _query_hash(query)), None)
+
+
+analysis_cache = AnalysisCache()
@@ -4,32 +4,165 @@ Fixes:
 - Made run_crew asynchronous and pass file_path into inputs.
 - Handled missing Crew/LLM and returned informative errors.
 - Used BackgroundTasks optionally for longer processing.
+- Streamed uploads to disk in chunks via aiofiles instead of buffering the whole file.
+- Streamed crew progress back as text/event-stream so clients see output before the run finishes.
+- Cached analyses by document hash + query (exact and semantic match) to skip repeat crew runs.
+- Precomputed the investment and risk tool outputs concurrently and passed them into the crew.
+- Ran verification as its own fast-model crew alongside the precompute step.
+- Coalesced concurrent identical requests onto a single crew run.
+- Moved uploaded-file cleanup to BackgroundTasks so it runs after the response is sent.
+- Sent Server-Sent Events: an immediate "accepted" event, one event per agent step, then the result.
 """
 from fastapi import FastAPI, File, UploadFile, Form, HTTPException, BackgroundTasks
+from sse_starlette.sse import EventSourceResponse
 import os
+import json
+import hashlib
 import uuid
 import asyncio
+from contextlib import asynccontextmanager
 from pathlib import Path
 
+import aiofiles
+
 from crewai import Crew, Process
-from agents import financial_analyst
-from task import analyze_financial_document  
+from agents import make_financial_analyst, make_verifier
+from cache import analysis_cache
+from task import make_analysis_task, make_verification_task
+from tools import InvestmentTool, RiskTool, register_upload_digest, forget_upload_digest, load_encoding, shutdown_pdf_pool
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # tiktoken may download its BPE file on first use; keep that off the request path
+    await asyncio.to_thread(load_encoding)
+    yield
+    await asyncio.to_thread(shutdown_pdf_pool)
+
+app = FastAPI(title="Financial Document Analyzer", lifespan=lifespan)
+
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB
+
+async def run_crew_async(query: str, file_path: str = "data/sample.pdf", progress: asyncio.Queue = None):
+    """
+    Run the crew and return its final result.
+    kickoff() is blocking, so it runs in a worker thread. If a progress queue is
+    given, each agent step is put on it as a progress event dict as it completes.
+    """
+    loop = asyncio.get_running_loop()
+
+    def step_reporter(agent):
+        def on_step(step_output):
+            if progress is not None:
+                event = {"status": "running", "agent": agent.role, "step": str(step_output)}
+                loop.call_soon_threadsafe(progress.put_nowait, event)
+        return on_step
+
+    async def kickoff(crew, inputs):
+        result = await loop.run_in_executor(None, crew.kickoff, inputs)
+        if asyncio.iscoroutine(result):
+            result = await result
+        return result
 
-app = FastAPI(title="Financial Document Analyzer")
+    async def precompute():
+        # The deterministic tools only depend on the document, so run them concurrently
+        # up front instead of as sequential agent tool-call round-trips. Both read the
+        # PDF directly (one shared streaming pass), so no full-text string is built here.
+        results = await asyncio.gather(
+            InvestmentTool.analyze_investment_tool("", file_path),
+            RiskTool.create_risk_assessment_tool("", file_path),
+        )
+        if progress is not None:
+            progress.put_nowait({"status": "running", "stage": "precompute", "detail": "Extracted values and ratios"})
+        return results
 
-async def run_crew_async(query: str, file_path: str = "data/sample.pdf"):
-    
-    # Ensure the Crew/Process classes exist
+    # Fresh agents and tasks per run: CrewAI mutates both during kickoff, and
+    # concurrent requests run their kickoffs in parallel worker threads
+    verifier = make_verifier()
+    financial_analyst = make_financial_analyst()
+    # Set on the agent itself: Crew(step_callback=...) is only copied onto agents
+    # that don't already have one
+    verifier.step_callback = step_reporter(verifier)
+    financial_analyst.step_callback = step_reporter(financial_analyst)
+    verification_crew = Crew(
+        agents=[verifier],
+        tasks=[make_verification_task(verifier)],
+        process=Process.sequential,
+    )
     financial_crew = Crew(
         agents=[financial_analyst],
-        tasks=[analyze_financial_document],
+        tasks=[make_analysis_task(financial_analyst)],
         process=Process.sequential,
     )
-    inputs = {"query": query, "file_path": file_path}
-    result = financial_crew.kickoff(inputs)
-    if asyncio.iscoroutine(result):
-        result = await result
-    return result
+    # Verification (fast model) runs alongside the precompute step; the analysis uses both
+    verification_result, (investment_metrics, risk_report) = await asyncio.gather(
+        kickoff(verification_crew, {"file_path": file_path}),
+        precompute(),
+    )
+    inputs = {
+        "query": query,
+        "file_path": file_path,
+        "verification": str(verification_result),
+        "investment_metrics": investment_metrics,
+        "risk_report": risk_report,
+    }
+    return await kickoff(financial_crew, inputs)
+
+def _sse(payload: dict) -> dict:
+    return {"data": json.dumps(payload)}
+
+def _safe_unlink(file_path: str):
+    forget_upload_digest(file_path)
+    try:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+    except Exception:
+        pass
+
+_DONE = object()
+# Strong references to detached crew runs; the event loop only keeps weak ones
+_RUNNING_JOBS = set()
+
+def _start_analysis(doc_hash: str, query: str, file_path: str, embedding, progress: asyncio.Queue):
+    """
+    Start a crew run that is owned by the in-flight registry rather than by the
+    HTTP stream that triggered it. On completion it resolves the shared future,
+    caches the result and posts _DONE on progress.
+    """
+    job = asyncio.ensure_future(run_crew_async(query=query.strip(), file_path=file_path, progress=progress))
+    _RUNNING_JOBS.add(job)
+
+    def on_done(job):
+        _RUNNING_JOBS.discard(job)
+        if job.cancelled():
+            analysis_cache.finish_inflight(doc_hash, query, error=RuntimeError("Analysis was cancelled"))
+        elif job.exception() is not None:
+            analysis_cache.finish_inflight(doc_hash, query, error=job.exception())
+        else:
+            analysis = str(job.result())
+            # Keep the resolved entry until the result is cached, so a request
+            # arriving in between joins it rather than starting another run
+            analysis_cache.finish_inflight(doc_hash, query, result=analysis, release=False)
+            store = asyncio.ensure_future(analysis_cache.set(doc_hash, query, analysis, embedding=embedding))
+            _RUNNING_JOBS.add(store)
+
+            def on_stored(store):
+                _RUNNING_JOBS.discard(store)
+                analysis_cache.release_inflight(doc_hash, query)
+
+            store.add_done_callback(on_stored)
+        # Step events are queued via call_soon_threadsafe before kickoff returns,
+        # so this sentinel always comes after the last step
+        progress.put_nowait(_DONE)
+
+    job.add_done_callback(on_done)
+    return job
+
+def _release_upload(file_path: str, upload: dict):
+    job = upload["job"]
+    if job is None or job.done():
+        _safe_unlink(file_path)
+    else:
+        job.add_done_callback(lambda _: _safe_unlink(file_path))
 
 @app.get("/")
 async def root():
@@ -50,35 +183,64 @@ async def analyze_endpoint(
     file_path = str(data_dir / f"financial_document_{file_id}.pdf")
 
     try:
-        # Save uploaded file
-        content = await file.read()
-        with open(file_path, "wb") as f:
-            f.write(content)
-
-        # Validate query
-        if not query or query.strip() == "":
-            query = "Analyze this financial document for investment insights"
-
-        # Run the crew asynchronously and await result
-        response = await run_crew_async(query=query.strip(), file_path=file_path)
-
-        return {
-            "status": "success",
-            "query": query,
-            "analysis": str(response),
-            "file_processed": file.filename
-        }
-
+        # Stream uploaded file to disk in chunks to keep memory bounded,
+        # hashing as we go so the cache can be keyed on document content
+        digest = hashlib.sha256()
+        async with aiofiles.open(file_path, "wb") as f:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                digest.update(chunk)
+                await f.write(chunk)
+        doc_hash = digest.hexdigest()
+        # Tools key their parse caches on this digest, so they needn't re-hash the file
+        register_upload_digest(file_path, doc_hash)
     except Exception as e:
+        _safe_unlink(file_path)
         raise HTTPException(status_code=500, detail=f"Error processing financial document: {str(e)}")
 
-    finally:
-        # Clean up uploaded file
+    # Validate query
+    if not query or query.strip() == "":
+        query = "Analyze this financial document for investment insights"
+
+    async def event_iter():
+        # Must stay an async generator: sync generators are run in a threadpool by Starlette
+        # Acknowledge right after the upload is saved so the client sees feedback immediately
+        yield _sse({"status": "accepted", "file_processed": file.filename})
         try:
-            if os.path.exists(file_path):
-                os.remove(file_path)
-        except Exception:
-            pass
+            cached, embedding = await analysis_cache.get(doc_hash, query)
+            if cached is not None:
+                yield _sse({
+                    "status": "success",
+                    "query": query,
+                    "analysis": cached,
+                    "file_processed": file.filename
+                })
+                return
+
+            is_leader, inflight = analysis_cache.join_inflight(doc_hash, query)
+            if is_leader:
+                progress: asyncio.Queue = asyncio.Queue()
+                upload["job"] = _start_analysis(doc_hash, query, file_path, embedding, progress)
+                # If this client disconnects we simply stop draining; the job keeps
+                # running for any followers and still lands in the cache
+                while (event := await progress.get()) is not _DONE:
+                    yield _sse(event)
+            # Leader and followers alike take the result from the shared in-flight future
+            analysis = await asyncio.shield(inflight)
+            yield _sse({
+                "status": "success",
+                "query": query,
+                "analysis": analysis,
+                "file_processed": file.filename
+            })
+        except Exception as e:
+            yield _sse({"status": "error", "detail": f"Error processing financial document: {str(e)}"})
+
+    # Clean up the uploaded file after the response has been sent (or, if this
+    # request started a crew run, once that run finishes). Parsed text is already
+    # memoized by content digest in tools, so re-uploads still skip parsing.
+    upload = {"job": None}
+    background_tasks.add_task(_release_upload, file_path, upload)
+    return EventSourceResponse(event_iter())
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,92 @@
+"""
+Shared provider rate limiting.
+One limiter per provider is shared by every agent and every in-flight request,
+replacing the per-agent max_rpm throttles. CrewAI issues LLM calls from the
+worker thread running kickoff(), so the limiter is thread-safe and blocking.
+Set REDIS_URL to share the budget across Uvicorn workers; if Redis is
+unreachable the limiter degrades to a per-process budget.
+"""
+import os
+import time
+import threading
+
+try:
+    import redis
+except Exception:
+    redis = None
+
+PROVIDER_RPM = int(os.getenv("PROVIDER_RPM", "40"))
+
+
+class TokenBucketLimiter:
+    """In-process token bucket refilled at max_rate tokens per time_period seconds."""
+
+    def __init__(self, max_rate: int, time_period: float = 60.0):
+        self.max_rate = max_rate
+        self._fill_rate = max_rate / time_period
+        self._tokens = float(max_rate)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.max_rate, self._tokens + (now - self._updated) * self._fill_rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self._fill_rate
+            time.sleep(wait)
+
+
+class RedisWindowLimiter:
+    """
+    Fixed-window counter in Redis (INCR + EXPIRE) shared by all processes.
+    If Redis is unreachable, calls fall back to an in-process token bucket.
+    """
+
+    def __init__(self, client, name: str, max_rate: int, time_period: int = 60):
+        self._client = client
+        self._name = name
+        self.max_rate = max_rate
+        self._period = time_period
+        self._fallback = TokenBucketLimiter(max_rate, time_period)
+
+    def acquire(self):
+        while True:
+            window = int(time.time() // self._period)
+            key = f"fa:rpm:{self._name}:{window}"
+            try:
+                count = self._client.incr(key)
+                if count == 1:
+                    self._client.expire(key, self._period)
+            except Exception:
+                self._fallback.acquire()
+                return
+            if count <= self.max_rate:
+                return
+            time.sleep(max(0.0, (window + 1) * self._period - time.time()))
+
+
+def make_limiter(name: str, max_rate: int = PROVIDER_RPM):
+    redis_url = os.getenv("REDIS_URL")
+    if redis is not None and redis_url:
+        return RedisWindowLimiter(redis.Redis.from_url(redis_url), name, max_rate)
+    return TokenBucketLimiter(max_rate)
+
+
+def rate_limited(llm, limiter):
+    """Route every llm.call() through the limiter. Returns llm (None passes through)."""
+    if llm is None:
+        return None
+    call = llm.call
+
+    def limited_call(*args, **kwargs):
+        limiter.acquire()
+        return call(*args, **kwargs)
+
+    # LLM classes are pydantic models; bypass field validation to shadow the bound method
+    object.__setattr__(llm, "call", limited_call)
+    return llm
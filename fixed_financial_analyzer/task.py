@@ -1,77 +1,103 @@
 """
 Fixes:
 - Rewrote task descriptions and expected outputs to be clear.
-- Used the verifier agent for verification tasks and financial_analyst for analysis.
 - Kept tasks deterministic and structured.
+- Kept per-request placeholders at the end of descriptions so the static prefix is prompt-cacheable.
+- Merged investment analysis and risk assessment into one structured-output task.
+- Kept verification as a separate task on the verifier agent so it runs on the fast model.
+- Built tasks per request; CrewAI interpolates inputs into the description and stores
+  task.output on the instance, so shared tasks would leak between concurrent runs.
 """
+from typing import List, Literal, Optional
+
 from crewai import Task
+from pydantic import BaseModel
 
-from agents import financial_analyst, verifier
 from tools import FinancialDocumentTool, InvestmentTool, RiskTool, search_tool
 
-analyze_financial_document = Task(
-    description=(
-        "Analyze the uploaded financial document. Steps:\n"
-        "1) Verify the document type.\n"
-        "2) Extract key financial statements (balance sheet, income statement, cash flow) where possible.\n"
-        "3) Compute basic financial ratios (profit margin, debt-to-equity, ROA) heuristically.\n"
-        "4) Produce a concise summary, a list of assumptions, and recommended next steps for due diligence.\n"
-        "Inputs available: {query}, and tools that can read the file."
-    ),
-    expected_output=(
-        "Return a structured response (preferably JSON or bullet list) with these sections:\n"
-        "- verification: {is_financial_document: bool, doc_type: str, explanation: str}\n"
-        "- extracted_values: {revenue, net_income, total_assets, total_liabilities, equity}\n"
-        "- ratios: {profit_margin, debt_to_equity, return_on_assets}\n"
-        "- summary: short human-friendly summary\n"
-        "- assumptions: list\n"
-        "- next_steps: list of recommended manual checks\n"
-    ),
-    agent=financial_analyst,
-    tools=[FinancialDocumentTool.read_data_tool, InvestmentTool.analyze_investment_tool, RiskTool.create_risk_assessment_tool, search_tool],
-    async_execution=False,
-)
+class Verification(BaseModel):
+    is_financial_document: bool
+    doc_type: str
+    explanation: str
+
+class ExtractedValues(BaseModel):
+    revenue: Optional[float] = None
+    net_income: Optional[float] = None
+    total_assets: Optional[float] = None
+    total_liabilities: Optional[float] = None
+    equity: Optional[float] = None
+
+class Ratios(BaseModel):
+    profit_margin: Optional[float] = None
+    debt_to_equity: Optional[float] = None
+    return_on_assets: Optional[float] = None
+
+class RiskAssessment(BaseModel):
+    risk_level: Literal["LOW", "MEDIUM", "HIGH"]
+    reasons: List[str]
 
-# Investment analysis task
-investment_analysis = Task(
-    description=(
-        "Analyze extracted financial data and compute ratios (profit margin, debt-to-equity, return on assets). "
-        "Provide an educational summary of financial strengths and weaknesses. "
-        "Do not give personalized investment advice."
-    ),
-    expected_output=(
-        "Return a structured summary with:\n"
-        "- extracted_values: dict\n"
-        "- ratios: dict\n"
-        "- analysis: short bullet list of strengths & weaknesses"
-    ),
-    agent=financial_analyst,  # could also use investment_advisor agent
-    tools=[InvestmentTool.analyze_investment_tool],
-    async_execution=False,
-)
+class FinancialAnalysis(BaseModel):
+    verification: Verification
+    extracted_values: ExtractedValues
+    ratios: Ratios
+    investment_analysis: List[str]
+    risk_assessment: RiskAssessment
+    summary: str
+    assumptions: List[str]
+    next_steps: List[str]
 
-# Risk assessment task
-risk_assessment = Task(
-    description=(
-        "Assess the financial risk based on ratios and extracted values. "
-        "Highlight risk factors such as high debt, low profitability, or negative income."
-    ),
-    expected_output=(
-        "Return a risk report with fields: {risk_level: LOW/MEDIUM/HIGH, reasons: list of strings}"
-    ),
-    agent=financial_analyst,  # could also use risk_assessor agent
-    tools=[RiskTool.create_risk_assessment_tool],
-    async_execution=False,
-)
+# Verification only needs a boolean + doc type, so it runs as its own task on the
+# verifier agent (fast model), concurrently with the deterministic precompute step.
+def make_verification_task(agent):
+    return Task(
+        description=(
+            "Verify whether the uploaded file is likely a financial document such as a balance sheet,"
+            " income statement or cash flow statement. Return a boolean, the document type and a short explanation.\n"
+            # Per-request inputs go last so the static prefix above stays cacheable
+            "Read the file at {file_path}."
+        ),
+        expected_output=(
+            "A JSON object with: is_financial_document (bool), doc_type "
+            "(e.g. 'financial_statement', 'invoice', 'unknown'), explanation (str)"
+        ),
+        agent=agent,
+        tools=[FinancialDocumentTool.read_data_tool],
+        output_json=Verification,
+        async_execution=False,
+    )
 
-# A verification task that uses the verifier agent
-verification = Task(
-    description=(
-        "Verify whether the uploaded file is likely a financial document such as a balance sheet,"
-        " income statement or cash flow statement. Return boolean and short explanation."
-    ),
-    expected_output="Return a dict-like string: {'is_financial_document': bool, 'doc_type': '...' , 'explanation': '...'}",
-    agent=verifier,
-    tools=[FinancialDocumentTool.read_data_tool],
-    async_execution=False,
-)
+# Single task covering extraction, investment and risk analysis on top of the
+# verification result; these share the same document text, so one structured call
+# replaces several round-trips.
+def make_analysis_task(agent):
+    return Task(
+        description=(
+            "Analyze the uploaded financial document. Steps:\n"
+            "1) Take the document type from the verification result provided below.\n"
+            "2) Extract key financial statements (balance sheet, income statement, cash flow) where possible.\n"
+            "3) Compute basic financial ratios (profit margin, debt-to-equity, ROA) heuristically.\n"
+            "4) Give an educational list of financial strengths and weaknesses. Do not give personalized investment advice.\n"
+            "5) Assess risk (LOW/MEDIUM/HIGH) from high debt, low profitability or negative income, with reasons.\n"
+            "6) Produce a concise summary, a list of assumptions, and recommended next steps for due diligence.\n"
+            # Per-request inputs go last so the static prefix above stays cacheable
+            "Inputs available: {query}, and tools that can read the file at {file_path}.\n"
+            "Verification result:\n{verification}\n"
+            "Precomputed investment metrics (heuristic):\n{investment_metrics}\n"
+            "Precomputed risk assessment (heuristic):\n{risk_report}"
+        ),
+        expected_output=(
+            "A single JSON object with these sections:\n"
+            "- verification: is_financial_document (bool), doc_type (str), explanation (str)\n"
+            "- extracted_values: revenue, net_income, total_assets, total_liabilities, equity\n"
+            "- ratios: profit_margin, debt_to_equity, return_on_assets\n"
+            "- investment_analysis: short list of strengths & weaknesses\n"
+            "- risk_assessment: risk_level (LOW/MEDIUM/HIGH), reasons (list of strings)\n"
+            "- summary: short human-friendly summary\n"
+            "- assumptions: list\n"
+            "- next_steps: list of recommended manual checks\n"
+        ),
+        agent=agent,
+        tools=[FinancialDocumentTool.read_data_tool, InvestmentTool.analyze_investment_tool, RiskTool.create_risk_assessment_tool, search_tool],
+        output_json=FinancialAnalysis,
+        async_execution=False,
+    )
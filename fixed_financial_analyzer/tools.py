@@ -4,92 +4,449 @@ Fixes:
 - Implemented a simple search_tool fallback (no external API required).
 - Implemented basic investment analysis and risk assessment functions that extract numeric values using regex and compute simple ratios.
 - Made read_data_tool a @staticmethod for easy use as a callable.
+- Precompiled the number/keyword regexes and scan each line once instead of once per field.
+- Extracted values from PDF tables (pdfplumber + pandas) when available, falling back to text regex.
+  Tables are parsed by page range in the process pool; any table failure falls back to the text path.
+- Memoized PDF text, table values and text extraction by content digest so repeated tool calls don't re-parse.
+- Extracted PDF pages in parallel across a process pool, off the event loop.
+- Trimmed read_data_tool output to keyword/number lines within a token budget before it reaches the LLM.
+- Switched page text extraction to pypdfium2, keeping PyPDF2 as a fallback.
+- Cached search_tool results in a bounded, TTL'd async LRU keyed on the normalized query.
+- Streamed pages from iter_pages into an incremental Extractor instead of joining and re-scanning the full text.
+- Parsed accounting negatives like $(1,234) correctly and stored extracted values as exact integer cents.
 """
+import os
 import re
+import multiprocessing
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 from pathlib import Path
 
+try:
+    import pypdfium2 as pdfium
+except Exception:
+    pdfium = None
+
 try:
     from PyPDF2 import PdfReader
 except Exception:
     PdfReader = None
 
+try:
+    from async_lru import alru_cache
+except Exception:
+    alru_cache = None
+
+try:
+    import tiktoken
+except Exception:
+    tiktoken = None
+
+try:
+    import pdfplumber
+    import pandas as pd
+except Exception:
+    pdfplumber = None
+
+_NUM_RE = re.compile(r'-?\d[\d,.]+')
+# Accounting negatives: "(1,234)" or "($1,234)" -> "-1,234"
+_PAREN_RE = re.compile(r'\(\s*\$?\s*(\d[\d,.]*)\s*\)')
+_KEY_RE = re.compile(r'assets|liabilities|revenue|sales|net income|profit|equity', re.I)
+# Parsed results keyed by file-content digest, so every agent/tool reading the
+# same document within (or across) requests parses it only once.
+_PDF_CACHE = {}
+_VALUES_CACHE = {}
+_CACHE_MAX_ENTRIES = 64
+
+_TEXT_VALUES_CACHE = {}
+# Upload path -> sha256 already computed while main.py streamed the upload to disk
+_UPLOAD_DIGESTS = {}
+
+def register_upload_digest(path, digest):
+    _UPLOAD_DIGESTS[os.path.abspath(path)] = digest
+
+def forget_upload_digest(path):
+    _UPLOAD_DIGESTS.pop(os.path.abspath(path), None)
+
+def _file_digest(path):
+    # sha256 to share keys with the upload-time digest
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+async def _digest_for(path):
+    """Reuse the upload digest when known; otherwise hash off the event loop."""
+    digest = _UPLOAD_DIGESTS.get(os.path.abspath(path))
+    if digest is None:
+        digest = await asyncio.to_thread(_file_digest, path)
+    return digest
+
+def _cache_put(cache, key, value):
+    # Dicts keep insertion order, so the first key is the oldest entry
+    if len(cache) >= _CACHE_MAX_ENTRIES:
+        cache.pop(next(iter(cache)))
+    cache[key] = value
+
+_KEY_FIELDS = {
+    "assets": "total_assets",
+    "liabilities": "total_liabilities",
+    "revenue": "revenue",
+    "sales": "revenue",
+    "net income": "net_income",
+    "profit": "net_income",
+    "equity": "equity",
+}
+
+_FIELD_PATTERNS = {
+    field: "|".join(re.escape(k) for k, f in _KEY_FIELDS.items() if f == field)
+    for field in dict.fromkeys(_KEY_FIELDS.values())
+}
+
+def _field_for_label(label):
+    """
+    Map a line/row label to a single field. Combined totals such as
+    "Total liabilities and stockholders' equity" name several fields and
+    hold neither value, so they are skipped (None).
+    """
+    fields = {_KEY_FIELDS[m.group(0).lower()] for m in _KEY_RE.finditer(label)}
+    return fields.pop() if len(fields) == 1 else None
+
+def _normalize_amounts(line):
+    line = _PAREN_RE.sub(r'-\1', line)
+    return line.replace("$", "").replace(",", "")
+
+def _to_cents(amount):
+    """Parse a normalized amount string into integer cents, exactly."""
+    return int((Decimal(amount) * 100).to_integral_value(rounding=ROUND_HALF_UP))
+
+def _format_cents(cents):
+    return f"{cents / 100:,.2f}"
+
+class Extractor:
+    """
+    Incremental keyword/number extractor. feed() any amount of text (a page,
+    a line) and finalize() once; only the field mapping is kept in memory.
+    Values are integer cents.
+    """
+
+    def __init__(self):
+        self.mapping = {}
+
+    def feed(self, text):
+        for line in text.splitlines():
+            field = _field_for_label(line)
+            if field is None:
+                continue
+            nums = _NUM_RE.findall(_normalize_amounts(line))
+            if not nums:
+                continue
+            try:
+                value = _to_cents(nums[-1])
+            except InvalidOperation:
+                continue
+            self.mapping[field] = value
+        return self
+
+    def finalize(self):
+        return self.mapping
+
 def _extract_numbers_from_text(text):
-    num_pattern = r'[-]?\(?\$?\s?[\d\.,]+(?:\)?)*'
-    candidates = re.findall(num_pattern, text)
-    mapping = {}
-    lines = text.splitlines()
-    for line in lines:
-        lower = line.lower()
-        if any(k in lower for k in ["total assets", "assets"]):
-            nums = re.findall(r'[-]?\d[\d,\.]+', line.replace(",", ""))
-            if nums:
-                try:
-                    mapping["total_assets"] = float(nums[-1])
-                except:
-                    pass
-        if any(k in lower for k in ["total liabilities", "liabilities"]):
-            nums = re.findall(r'[-]?\d[\d,\.]+', line.replace(",", ""))
-            if nums:
-                try:
-                    mapping["total_liabilities"] = float(nums[-1])
-                except:
-                    pass
-        if any(k in lower for k in ["revenue", "total revenue", "sales"]):
-            nums = re.findall(r'[-]?\d[\d,\.]+', line.replace(",", ""))
-            if nums:
-                try:
-                    mapping["revenue"] = float(nums[-1])
-                except:
-                    pass
-        if any(k in lower for k in ["net income", "profit", "net profit"]):
-            nums = re.findall(r'[-]?\d[\d,\.]+', line.replace(",", ""))
-            if nums:
-                try:
-                    mapping["net_income"] = float(nums[-1])
-                except:
-                    pass
-        if any(k in lower for k in ["equity", "shareholders' equity", "total equity"]):
-            nums = re.findall(r'[-]?\d[\d,\.]+', line.replace(",", ""))
-            if nums:
-                try:
-                    mapping["equity"] = float(nums[-1])
-                except:
-                    pass
+    # Keyed on a digest so cached entries don't pin whole documents in memory
+    digest = hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+    mapping = _TEXT_VALUES_CACHE.get(digest)
+    if mapping is None:
+        mapping = Extractor().feed(text).finalize()
+        _cache_put(_TEXT_VALUES_CACHE, digest, mapping)
     return mapping
 
+def _read_table_range(path, start, stop):
+    """Return pdfplumber tables for pages [start, stop). Runs inside a pool worker."""
+    with pdfplumber.open(str(path), pages=list(range(start + 1, stop + 1))) as pdf:
+        return [page.extract_tables() for page in pdf.pages]
+
+async def _read_tables(path):
+    """
+    Return pdfplumber tables for every page, or [] if pdfplumber/pandas are unavailable.
+    pdfplumber is pure Python and holds the GIL, so page ranges are parsed in the
+    process pool rather than on a server thread.
+    """
+    if pdfplumber is None:
+        return []
+    loop = asyncio.get_running_loop()
+    page_count = await loop.run_in_executor(_pdf_executor(), _count_pages, str(path))
+    chunks = [
+        loop.run_in_executor(_get_pdf_pool(), _read_table_range, str(path), start, stop)
+        for start, stop in _page_ranges(page_count)
+    ]
+    return [page for chunk in await asyncio.gather(*chunks) for page in chunk]
+
+def _extract_numbers_from_tables(tables):
+    """
+    Vectorized extraction over table rows: first cell is the label, last
+    non-empty cell is the value. Later rows win, matching the text extractor,
+    and combined "X and Y" total rows are skipped.
+    Parenthesized values are negative; results are integer cents.
+    """
+    rows = []
+    for page in tables:
+        for table in page:
+            for row in table:
+                if not row or len(row) < 2 or not row[0]:
+                    continue
+                value = next((c for c in reversed(row[1:]) if c), None)
+                if value:
+                    rows.append((row[0], value))
+    if not rows:
+        return {}
+
+    df = pd.DataFrame(rows, columns=["label", "value"])
+    labels = df["label"].str.lower()
+    # One boolean column per field; rows naming more than one field are combined
+    # totals and are skipped, same as _field_for_label() in the text path
+    hits = pd.DataFrame({field: labels.str.contains(pattern, regex=True) for field, pattern in _FIELD_PATTERNS.items()})
+    df["field"] = hits.idxmax(axis=1).where(hits.sum(axis=1) == 1)
+    df = df.dropna(subset=["field"])
+    negative = df["value"].str.contains("(", regex=False)
+    amount = pd.to_numeric(df["value"].str.replace(r"[,$()\s]", "", regex=True), errors="coerce")
+    df["amount"] = amount.where(~negative, -amount)
+    df = df.dropna(subset=["amount"])
+    # Integer cents, matching the text extractor
+    cents = (df["amount"] * 100).round().astype("int64")
+    return {field: int(v) for field, v in cents.groupby(df["field"], sort=False).last().items()}
+
+async def _extract_values_from_file(file_path):
+    try:
+        mapping = _extract_numbers_from_tables(await _read_tables(file_path))
+    except Exception:
+        # Unparseable tables shouldn't fail the run; the text path below still works
+        mapping = {}
+    if mapping:
+        return mapping
+    # No usable tables: stream pages straight into the extractor in a single pass
+    extractor = Extractor()
+    async for page in FinancialDocumentTool.iter_pages(file_path):
+        extractor.feed(page)
+    return extractor.finalize()
+
+async def _extract_financial_values(text, file_path=None):
+    """Prefer the PDF itself (tables, then page text); fall back to regex over the given text."""
+    if file_path and Path(file_path).exists():
+        digest = await _digest_for(file_path)
+        # Cache the task rather than its result so concurrent callers share one extraction
+        task = _VALUES_CACHE.get(digest)
+        if task is None:
+            task = asyncio.ensure_future(_extract_values_from_file(file_path))
+            _cache_put(_VALUES_CACHE, digest, task)
+        try:
+            mapping = await asyncio.shield(task)
+        except Exception:
+            _VALUES_CACHE.pop(digest, None)
+            raise
+        if mapping:
+            return dict(mapping)
+    return dict(_extract_numbers_from_text(text or ""))
+
+PDF_WORKERS = os.cpu_count() or 1
+PARALLEL_MIN_PAGES = 16
+_PDF_POOL = None
+
+def _get_pdf_pool():
+    global _PDF_POOL
+    if _PDF_POOL is None:
+        # Not fork: the server process already has live threads (executor pool,
+        # torch) and forking it lazily can deadlock the child. forkserver is
+        # POSIX-only, so Windows uses spawn.
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        _PDF_POOL = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context(method))
+    return _PDF_POOL
+
+def shutdown_pdf_pool():
+    """Stop the PDF worker processes, if any were started."""
+    global _PDF_POOL
+    if _PDF_POOL is not None:
+        _PDF_POOL.shutdown(cancel_futures=True)
+        _PDF_POOL = None
+
+def _pdf_executor():
+    """
+    PDFium is not thread-safe, even across separate documents, so every pdfium
+    call runs in a pool worker process (one task at a time per process). The
+    PyPDF2 fallback is thread-safe and uses the default thread pool.
+    """
+    return _get_pdf_pool() if pdfium is not None else None
+
+def _page_ranges(page_count):
+    """Split [0, page_count) into one [start, stop) range per pool worker."""
+    # Each worker re-opens the file, so only fan out when there are enough pages to pay for it
+    if page_count <= PARALLEL_MIN_PAGES:
+        return [(0, page_count)]
+    step = -(-page_count // PDF_WORKERS)
+    return [(start, min(start + step, page_count)) for start in range(0, page_count, step)]
+
+def _count_pages(path):
+    if pdfium is not None:
+        pdf = pdfium.PdfDocument(path)
+        try:
+            return len(pdf)
+        finally:
+            pdf.close()
+    return len(PdfReader(path).pages)
+
+def _normalize_page_text(text):
+    # Normalize whitespace
+    return '\n'.join([ln.strip() for ln in text.splitlines() if ln.strip()])
+
+def _extract_page_range_pdfium(path, start, stop):
+    pdf = pdfium.PdfDocument(path)
+    try:
+        texts = []
+        for i in range(start, stop):
+            try:
+                page = pdf[i]
+                textpage = page.get_textpage()
+                texts.append(textpage.get_text_range())
+                textpage.close()
+                page.close()
+            except Exception:
+                texts.append("")
+        return texts
+    finally:
+        pdf.close()
+
+def _extract_page_range_pypdf2(path, start, stop):
+    reader = PdfReader(path)
+    texts = []
+    for i in range(start, stop):
+        try:
+            texts.append(reader.pages[i].extract_text() or "")
+        except Exception:
+            texts.append("")
+    return texts
+
+def _extract_page_range(path, start, stop):
+    """
+    Extract normalized text for pages [start, stop). Runs inside a pool worker.
+    Uses pypdfium2 (C PDFium bindings) when installed, otherwise PyPDF2.
+    """
+    if pdfium is not None:
+        texts = _extract_page_range_pdfium(path, start, stop)
+    else:
+        texts = _extract_page_range_pypdf2(path, start, stop)
+    return [_normalize_page_text(text) for text in texts if text and text.strip()]
+
+EXCERPT_MAX_TOKENS = 2000
+EXCERPT_TOKEN_MODEL = "gpt-4o"
+# None until load_encoding() has run; False if tiktoken or its BPE file is unavailable
+_ENCODING = None
+
+def load_encoding():
+    """
+    Load the tiktoken encoding. The first load may download its BPE file, so
+    main.py calls this once at startup in a worker thread, off the request path.
+    """
+    global _ENCODING
+    if _ENCODING is not None:
+        return _ENCODING
+    if tiktoken is None:
+        _ENCODING = False
+        return _ENCODING
+    try:
+        try:
+            _ENCODING = tiktoken.encoding_for_model(EXCERPT_TOKEN_MODEL)
+        except KeyError:
+            _ENCODING = tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        _ENCODING = False
+    return _ENCODING
+
+def _truncate_tokens(text, max_tokens):
+    encoding = _ENCODING
+    if not encoding:
+        # Not loaded (yet) or unavailable: ~4 characters per token for English text
+        return text[:max_tokens * 4]
+    tokens = encoding.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
+
+def _relevant_excerpt(text, max_tokens=EXCERPT_MAX_TOKENS):
+    """
+    Keep only lines with both a financial keyword and a number, plus one line of
+    context either side. Falls back to the head of the text if nothing matches.
+    """
+    lines = text.splitlines()
+    keep = set()
+    for i, line in enumerate(lines):
+        if _KEY_RE.search(line) and _NUM_RE.search(line):
+            keep.update((i - 1, i, i + 1))
+    if keep:
+        text = "\n".join(lines[i] for i in sorted(keep) if 0 <= i < len(lines))
+    return _truncate_tokens(text, max_tokens)
+
 class FinancialDocumentTool:
     @staticmethod
     async def read_data_tool(path: str = "data/sample.pdf"):
+        """
+        Read the PDF and return the lines relevant to financial analysis
+        (keyword + number lines with surrounding context), capped at
+        EXCERPT_MAX_TOKENS so the LLM prompt stays small.
+        """
+        return _relevant_excerpt(await FinancialDocumentTool.read_full_text(path))
+
+    @staticmethod
+    async def read_full_text(path: str = "data/sample.pdf"):
         """
         Read PDF text and return as a single string.
-        Uses PyPDF2 if available, otherwise raises an informative error.
+        Uses pypdfium2 or PyPDF2 if available, otherwise raises an informative error.
+        Results are memoized by file-content digest.
+        """
+        return "\n\n".join([page async for page in FinancialDocumentTool.iter_pages(path)])
+
+    @staticmethod
+    async def iter_pages(path: str = "data/sample.pdf"):
+        """
+        Yield normalized page text in page order as soon as each chunk is parsed.
+        Pages are memoized by file-content digest once a full pass completes.
         """
         p = Path(path)
         if not p.exists():
             raise FileNotFoundError(f"PDF file not found: {path}")
-        if PdfReader is None:
-            raise RuntimeError("PyPDF2 is required for PDF reading. Please install with 'pip install PyPDF2'")
+        if pdfium is None and PdfReader is None:
+            raise RuntimeError("pypdfium2 or PyPDF2 is required for PDF reading. Please install with 'pip install pypdfium2'")
 
-        reader = PdfReader(str(p))
-        full_text = []
-        for page in reader.pages:
-            try:
-                text = page.extract_text()
-            except Exception:
-                text = ""
-            if text:
-                # Normalize whitespace
-                text = '\n'.join([ln.strip() for ln in text.splitlines() if ln.strip()])
-                full_text.append(text)
-        return "\n\n".join(full_text)
+        digest = await _digest_for(p)
+        cached = _PDF_CACHE.get(digest)
+        if cached is not None:
+            for page in cached:
+                yield page
+            return
+
+        loop = asyncio.get_running_loop()
+        executor = _pdf_executor()
+        page_count = await loop.run_in_executor(executor, _count_pages, str(p))
+        ranges = _page_ranges(page_count)
+        # A single range can stay on the PyPDF2 thread pool; fan-out always uses processes
+        if len(ranges) > 1:
+            executor = _get_pdf_pool()
+        chunks = [loop.run_in_executor(executor, _extract_page_range, str(p), start, stop) for start, stop in ranges]
+        pages = []
+        for chunk in chunks:
+            for page in await chunk:
+                pages.append(page)
+                yield page
+        _cache_put(_PDF_CACHE, digest, pages)
 
 class InvestmentTool:
     @staticmethod
-    async def analyze_investment_tool(financial_document_data: str):
-        if not financial_document_data:
+    async def analyze_investment_tool(financial_document_data: str, file_path: str = None):
+        if not financial_document_data and not file_path:
             return "No document text provided."
 
-        extracted = _extract_numbers_from_text(financial_document_data)
+        extracted = await _extract_financial_values(financial_document_data, file_path)
         results = {}
         revenue = extracted.get("revenue")
         net_income = extracted.get("net_income")
@@ -119,7 +476,7 @@ class InvestmentTool:
         summary_lines = []
         summary_lines.append("Extracted financial values (heuristic):")
         for k, v in extracted.items():
-            summary_lines.append(f"- {k}: {v}")
+            summary_lines.append(f"- {k}: {_format_cents(v)}")
         summary_lines.append("")
         summary_lines.append("Computed ratios (when possible):")
         for k, v in results.items():
@@ -133,13 +490,14 @@ class InvestmentTool:
 
 class RiskTool:
     @staticmethod
-    async def create_risk_assessment_tool(financial_document_data: str):
+    async def create_risk_assessment_tool(financial_document_data: str, file_path: str = None):
         """
         Produce a simple risk level based on heuristics:
         - high debt_to_equity -> higher risk
         - negative profit margin -> higher risk
+        Values come from the PDF's tables when file_path is given, otherwise from the text.
         """
-        extracted = _extract_numbers_from_text(financial_document_data)
+        extracted = await _extract_financial_values(financial_document_data, file_path)
         total_liabilities = extracted.get("total_liabilities")
         equity = extracted.get("equity")
         revenue = extracted.get("revenue")
@@ -170,16 +528,28 @@ class RiskTool:
 
         return f"Risk level: {level}\nReasons: {', '.join(reasons) if reasons else 'Not enough data to determine risk.'}"
 
+_WS_RE = re.compile(r'\s+')
+
+async def _search(query: str):
+    # Swap this body for the real SerpAPI/Serper call
+    return [
+        {"title": "Company Filings (example)", "link": "https://www.example.com/filings"},
+        {"title": "Financial Ratios Reference", "link": "https://www.example.com/ratios"}
+    ]
+
+# Cache results for an hour when async-lru is installed; otherwise search uncached
+_cached_search = alru_cache(maxsize=1024, ttl=3600)(_search) if alru_cache is not None else _search
+
 # Simple search tool fallback (no external API)
 async def search_tool(query: str, limit: int = 3):
     """
     A very small, deterministic search-tool stub that returns zero or simple canned results.
     Replace this with a SerpAPI/Serper integration for real searches.
+    Queries are normalized (case, whitespace) and cached, so repeats within the TTL return instantly.
     """
     if not query:
         return []
-    
-    return [
-        {"title": "Company Filings (example)", "link": "https://www.example.com/filings"},
-        {"title": "Financial Ratios Reference", "link": "https://www.example.com/ratios"}
-    ]
+
+    # limit is applied after the cache so every limit shares one cached entry per query
+    results = await _cached_search(_WS_RE.sub(" ", query).strip().lower())
+    return list(results[:limit])